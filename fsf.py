@@ -1,14 +1,63 @@
 """
 Module contains functions useful for interacting with and manipulating file systems and structures.
 """
-from os import scandir, path as ospath, remove as osrmv, chdir, mkdir, getcwd
-from hashlib import md5
+from os import scandir, DirEntry, path as ospath, remove as osrmv, chdir, mkdir, getcwd, cpu_count, stat, environ, SEEK_END
+from os import open as osopen, write as oswrite, close as osclose, O_WRONLY, O_CREAT, O_TRUNC
+from hashlib import md5, sha256
 from random import randint
 from sys import path as syspath
 from pathlib import Path
 from typing import Generator, Iterable
 from contextlib import contextmanager
-from itertools import chain
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from sqlite3 import connect, Connection, Error as SQLiteError
+from threading import Lock
+from zlib import crc32
+
+try:
+    from os import posix_fadvise, POSIX_FADV_SEQUENTIAL
+except ImportError:  # Not available on Windows, reads are not hinted there.
+    posix_fadvise = None
+try:
+    from xxhash import xxh3_128
+except ImportError:  # xxhash is optional, sha256 is used unless it is installed and selected.
+    xxh3_128 = None
+try:
+    import blake3
+except ImportError:  # blake3 is optional, sha256 is used unless it is installed and selected.
+    blake3 = None
+
+# Hash constructors that can be used to compare file contents, keyed by name.
+HASH_BACKENDS = {'sha256': sha256, 'md5': md5}  # md5 is kept for compatibility with older hashes only.
+if xxh3_128 is not None:
+    HASH_BACKENDS['xxh3_128'] = xxh3_128
+if blake3 is not None:  # Hashes each large chunk across all cores.
+    HASH_BACKENDS['blake3'] = lambda: blake3.blake3(max_threads=blake3.blake3.AUTO)
+# The name of the entry in HASH_BACKENDS used to hash files, can be set with the FSF_HASH_BACKEND environment variable.
+HASH_BACKEND = environ.get('FSF_HASH_BACKEND', 'sha256')
+# The number of bytes compared from the start and end of same sized files before they are fully hashed.
+COMPARE_BLOCK_SIZE = 4096
+# The size in bytes below which files_equal compares file contents directly rather than by hash.
+DIRECT_COMPARE_SIZE = 4 * 1024 * 1024
+# The number of bytes read from a file at a time while it is hashed.
+HASH_CHUNK_SIZE = 1 << 20
+# The number of files above which hashing is spread across a pool of threads.
+PARALLEL_HASH_THRESHOLD = 16
+# The number of sub-folders above which a folder's sub-folders are walked on a pool of threads.
+PARALLEL_WALK_THRESHOLD = 4
+# The SQLite database file hashes are cached in between runs, set to None to disable the cache.
+try:
+    HASH_CACHE_PATH = Path(environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'fsf' / 'hashes.sqlite'
+except RuntimeError:  # No home directory to keep the cache in, so the cache is disabled.
+    HASH_CACHE_PATH = None
+
+_hash_memo = {}  # In-process cache of digests looked up this run, (dev, ino, backend) -> ((mtime_ns, size), digest).
+_hash_db = None  # The open connection to the hash cache, see _hash_cache.
+_hash_db_path = None  # The path _hash_db was opened for.
+_hash_db_lock = Lock()
+_PATH_TYPE = type(Path())  # The concrete Path class for this platform, e.g. PosixPath.
+_DUP_TEST_CONTENT = b'This is a randomly generated duplicate file.'  # Shared by every duplicate test file.
 
 
 @contextmanager
@@ -27,25 +76,206 @@ def in_dir(directory: str | Path) -> None:
 
 def files_equal(file1: Path | str, file2: Path | str) -> bool:
     """
-    Hashes the files at the given paths and returns whether they have equal content.
+    Returns whether the files at the given paths have equal content. Files that are the same file on disk or differ in
+    size are answered from their metadata, small files are compared byte for byte and larger ones by hash.
     :param file1: The location of one of the files in the comparison.
     :param file2: The location of the other file in the comparison.
     :return: boolean True if the files have equal contents.
     """
-    return hash_from_path(file1) == hash_from_path(file2)
+    st1, st2 = stat(file1), stat(file2)
+    if st1.st_ino and (st1.st_dev, st1.st_ino) == (st2.st_dev, st2.st_ino):  # Hard links to, or paths of, one file.
+        return True
+    if st1.st_size != st2.st_size:
+        return False
+    if st1.st_size < DIRECT_COMPARE_SIZE:
+        with open(file1, 'rb') as f1, open(file2, 'rb') as f2:
+            return f1.read() == f2.read()
+    return _digest(file1) == _digest(file2)
 
 
 def hash_from_path(path: Path | str) -> str:
     """ 
-    Returns the hash of a file given its path.
+    Returns the hash of a file given its path. Hashes are cached by file identity, modification time and size so
+    unchanged files are not read again, see HASH_CACHE_PATH.
     :param path: The path to the file to get the hash for.
     :return: A string hash of the file at the path.
     """
-    hasher = md5()
-    with open(path_handler(path).resolve(), 'rb') as f:
-        buf = f.read()
-        hasher.update(buf)
-        return hasher.hexdigest()
+    return _digest(path).hex()
+
+
+def _digest(path: Path | str, pending: list[tuple] = None) -> bytes:
+    """
+    Returns the raw digest of a file given its path, using the hash cache. Used internally in place of
+    hash_from_path as bytes digests are half the size of their hex strings and cheaper to group by.
+    :param path: The path to the file to get the digest for.
+    :param pending: If given, new cache rows are appended here for the caller to store with _store_digests, rather
+    than each being written in its own transaction.
+    :return: The digest of the file at the path.
+    """
+    st = stat(path)
+    if not st.st_ino:  # The file system gives no stable identity to cache the hash by.
+        return _hash_file(path)
+    key = (st.st_dev, st.st_ino, HASH_BACKEND)
+    version = (st.st_mtime_ns, st.st_size)
+    try:
+        cached_version, digest = _hash_memo[key]
+        if cached_version == version:
+            return digest
+    except KeyError:
+        pass
+    with _hash_db_lock:
+        db = _hash_cache()
+        try:
+            row = None if db is None else db.execute(
+                'SELECT digest FROM digests WHERE dev = ? AND ino = ? AND backend = ? AND mtime_ns = ? AND size = ?',
+                (*key, *version)).fetchone()
+        except SQLiteError:  # E.g. locked by another process, hash the file as if it was not cached.
+            row = None
+    if row is not None:
+        digest = row[0]
+    else:
+        digest = _hash_file(path)
+        if pending is None:
+            _store_digests([(*key, *version, digest)])
+        else:
+            pending.append((*key, *version, digest))
+    _hash_memo[key] = (version, digest)
+    return digest
+
+
+def _store_digests(rows: list[tuple]):
+    """
+    Writes new rows to the hash cache in a single transaction. If the cache can't be written to, e.g. because
+    another process holds it locked, the rows are dropped.
+    :param rows: A list of (dev, ino, backend, mtime_ns, size, digest) rows.
+    """
+    with _hash_db_lock:
+        db = _hash_cache()
+        if db is not None and rows:
+            _write_cache(db, 'INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+
+def _write_cache(db: Connection, sql: str, rows: Iterable[tuple]) -> bool:
+    """
+    Runs a statement over rows in a single transaction on the hash cache, rolling back if it fails. Must be called
+    while holding _hash_db_lock.
+    :param db: The hash cache connection.
+    :param sql: The statement to run for each row.
+    :param rows: The parameters for each run of the statement.
+    :return: boolean True if the rows were written.
+    """
+    try:
+        db.execute('BEGIN')
+        db.executemany(sql, rows)
+        db.execute('COMMIT')
+        return True
+    except SQLiteError:  # The cache only saves time, so failing to write to it is not an error.
+        if db.in_transaction:
+            db.rollback()
+        return False
+
+
+def _forget_digest(path: Path | str):
+    """
+    Drops the cached digest of a file, from this run and from the hash cache, so it is hashed again next time.
+    :param path: The path of the file.
+    """
+    try:
+        st = stat(path)
+    except OSError:
+        return
+    key = (st.st_dev, st.st_ino, HASH_BACKEND)
+    _hash_memo.pop(key, None)
+    with _hash_db_lock:
+        db = _hash_cache()
+        if db is not None:
+            _write_cache(db, 'DELETE FROM digests WHERE dev = ? AND ino = ? AND backend = ?', [key])
+
+
+def _hash_file(path: Path | str) -> bytes:
+    """
+    Reads and hashes the file at the given path, bypassing the hash cache.
+    :param path: The path to the file to hash.
+    :return: The digest of the file at the path.
+    """
+    hasher = new_hasher()
+    with open(path, 'rb') as f:
+        if posix_fadvise is not None:
+            posix_fadvise(f.fileno(), 0, 0, POSIX_FADV_SEQUENTIAL)
+        while chunk := f.read(HASH_CHUNK_SIZE):  # Stream the file so large files are not held in memory.
+            hasher.update(chunk)
+        return hasher.digest()
+
+
+def _hash_cache() -> Connection | None:
+    """
+    Returns the connection to the database at HASH_CACHE_PATH, opening it the first time it is needed. Must be called
+    while holding _hash_db_lock.
+    :return: The database connection, or None if the cache is disabled or could not be opened.
+    """
+    global _hash_db, _hash_db_path
+    if HASH_CACHE_PATH != _hash_db_path:
+        if _hash_db is not None:
+            _hash_db.close()
+        _hash_db, _hash_db_path = None, HASH_CACHE_PATH
+        if HASH_CACHE_PATH is not None:
+            try:
+                path_handler(HASH_CACHE_PATH).parent.mkdir(parents=True, exist_ok=True)
+                # A short timeout so a cache locked by another process is skipped rather than waited on.
+                _hash_db = connect(HASH_CACHE_PATH, timeout=1, isolation_level=None, check_same_thread=False)
+                _hash_db.execute('PRAGMA journal_mode = WAL')
+                _hash_db.execute('PRAGMA synchronous = NORMAL')
+                _hash_db.execute('CREATE TABLE IF NOT EXISTS digests (dev INTEGER, ino INTEGER, backend TEXT, '
+                                 'mtime_ns INTEGER, size INTEGER, digest BLOB, PRIMARY KEY (dev, ino, backend))')
+                # The copy of each content kept by remove_duplicates, per directory it was run on.
+                _hash_db.execute('CREATE TABLE IF NOT EXISTS kept_copies (root TEXT, backend TEXT, digest BLOB, '
+                                 'path TEXT, size INTEGER, PRIMARY KEY (root, backend, digest))')
+            except (OSError, SQLiteError):  # The cache only saves time, hashing works without it.
+                if _hash_db is not None:
+                    _hash_db.close()
+                _hash_db = None
+    return _hash_db
+
+
+def new_hasher():
+    """
+    Creates a new hash object using the currently selected HASH_BACKEND.
+    :return: A hash object with update and digest methods.
+    """
+    try:
+        return HASH_BACKENDS[HASH_BACKEND]()
+    except KeyError:
+        raise ValueError(f'Unknown hash backend \'{HASH_BACKEND}\', expected one of: '
+                         f'{", ".join(HASH_BACKENDS)}.') from None
+
+
+def hash_many(paths: Iterable[Path | str], workers: int = None) -> list[tuple[Path | str, str]]:
+    """
+    Hashes each of the files at the given paths, pairing each path with the hash of its file. Files are hashed on a
+    pool of threads when there are more than PARALLEL_HASH_THRESHOLD of them.
+    :param paths: The paths of the files to hash.
+    :param workers: The maximum number of threads to hash with, defaults to four per CPU (at most 32).
+    :return: A list of (path, hash) pairs in the same order as the given paths.
+    """
+    return [(path, digest.hex()) for path, digest in _digest_many(paths, workers)]
+
+
+def _digest_many(paths: Iterable[Path | str], workers: int = None) -> list[tuple[Path | str, bytes]]:
+    """
+    Gets the raw digest of each of the files at the given paths as hash_many does.
+    :param paths: The paths of the files to hash.
+    :param workers: The maximum number of threads to hash with, see hash_many.
+    :return: A list of (path, digest) pairs in the same order as the given paths.
+    """
+    paths = list(paths)
+    pending = []  # New cache rows, stored together once every file is hashed.
+    try:
+        if len(paths) <= PARALLEL_HASH_THRESHOLD:  # Not worth starting a pool for.
+            return [(path, _digest(path, pending)) for path in paths]
+        with ThreadPoolExecutor(max_workers=workers or _default_workers()) as executor:
+            return list(zip(paths, executor.map(lambda path: _digest(path, pending), paths)))
+    finally:
+        _store_digests(pending)
 
 
 def subfiles(directory: Path | str) -> Generator[Path]:
@@ -54,8 +284,8 @@ def subfiles(directory: Path | str) -> Generator[Path]:
     :param directory: The directory in which to search.
     :return: The list of file paths in the given directory.
     """
-    direc = path_handler(directory).resolve()
-    return (Path(f'{direc}') / f.name for f in scandir(direc) if f.is_file())
+    direc = ospath.abspath(path_handler(directory))
+    return (Path(f.path) for f in scandir(direc) if f.is_file())
 
 
 def subdirs(directory: Path | str) -> Generator[Path]:
@@ -64,22 +294,59 @@ def subdirs(directory: Path | str) -> Generator[Path]:
     :param directory: The string path of the folder from which to extract the paths of sub-folders from.
     :return: A list of sub folder paths.
     """
-    direc = path_handler(directory).resolve()
-    return (Path(f'{direc}') / f.name for f in scandir(direc) if f.is_dir())
+    direc = ospath.abspath(path_handler(directory))
+    return (Path(f.path) for f in scandir(direc) if f.is_dir())
 
 
-def subpaths(directory: Path | str) -> Generator[Path]:
+def subpaths(directory: Path | str, workers: int = None) -> Generator[Path]:
     """
-    Gets the resolved paths of every sub file in every sub folder into one list
-    (all end points in the tree below the entry point given).
+    Gets the absolute paths of every sub file in every sub folder into one list
+    (all end points in the tree below the entry point given). Symlinks in the given directory's own path are resolved,
+    those below it are not, so files under a linked sub-folder are given through the link. Once a folder with more than PARALLEL_WALK_THRESHOLD
+    sub-folders is reached, each of its sub-folders is walked on a separate thread.
     :param directory: The root directory to get the tree of.
+    :param workers: The maximum number of threads to walk with, defaults to four per CPU (at most 32). 1 walks serially.
     :return: An iterable of string paths of each sub file.
     """
-    direc = path_handler(directory)
-    sf = subfiles(direc)
-    for d in subdirs(direc):
-        sf = chain(sf, subpaths(d))
-    return sf
+    return (Path(entry.path) for entry in _subentries(directory, workers))
+
+
+def _subentries(directory: Path | str, workers: int = None, follow_symlinks: bool = True) -> Generator[DirEntry]:
+    """
+    Walks the tree below the given directory as subpaths does, keeping the scandir entries so their cached file
+    information can be used without another stat. Resolves the directory once and leaves the walk itself to _walk.
+    :param directory: The root directory to get the tree of.
+    :param workers: The maximum number of threads to walk with, see subpaths.
+    :param follow_symlinks: Whether symlinks to files and folders are walked, when False they are skipped.
+    :return: An iterable of the DirEntry of each sub file.
+    """
+    return _walk(str(path_handler(directory).resolve()), workers, follow_symlinks)
+
+
+def _walk(root: str, workers: int = None, follow_symlinks: bool = True) -> Generator[DirEntry]:
+    """
+    Walks the tree below an already resolved root for _subentries, scanning each folder once. Folders waiting to be
+    scanned are kept on a stack rather than recursed into, so the cost of each step does not grow with the depth of
+    the tree. Only the root is resolved, every folder below it is reached by joining names onto it with DirEntry.path,
+    including the folders walked on other threads.
+    :param root: The resolved path of the root directory.
+    :param workers: The maximum number of threads to walk with, see subpaths.
+    :param follow_symlinks: Whether symlinks to files and folders are walked, see _subentries.
+    :return: An iterable of the DirEntry of each sub file.
+    """
+    stack = deque([root])
+    while stack:
+        with scandir(stack.pop()) as it:
+            entries = list(it)
+        dirs = [entry.path for entry in entries if entry.is_dir(follow_symlinks=follow_symlinks)]
+        yield from (entry for entry in entries if entry.is_file(follow_symlinks=follow_symlinks))
+        if workers == 1 or len(dirs) <= PARALLEL_WALK_THRESHOLD:
+            stack.extend(reversed(dirs))  # Reversed so sub-folders are popped in the order they were listed.
+            continue
+        # Sub-folders are walked serially within each thread so that pools are never nested.
+        with ThreadPoolExecutor(max_workers=workers or _default_workers()) as executor:
+            for tree in executor.map(lambda d: list(_walk(d, 1, follow_symlinks)), dirs):
+                yield from tree
 
 
 def get_duplicates(include: Path | Iterable[Path], exclude: Path | Iterable[Path] = None):
@@ -91,35 +358,77 @@ def get_duplicates(include: Path | Iterable[Path], exclude: Path | Iterable[Path
     """
     # Find the paths of all the files to check for duplicates.
     if isinstance(include, Path) or isinstance(include, str):  # One directory given
-        paths = list(subpaths(include))
+        entries = list(_subentries(include))
     elif isinstance(include, list):  # Multiple directories given
-        paths = [path for dir in include for path in subpaths(dir)]
+        entries = [entry for dir in include for entry in _subentries(dir)]
     else:
         raise NotImplementedError
     # Find the paths of all the files to exclude from the search.
     if exclude is not None:
-        if isinstance(exclude, str):
-            exc = subpaths(exclude)
+        if isinstance(exclude, Path) or isinstance(exclude, str):
+            exc = {entry.path for entry in _subentries(exclude)}
         elif isinstance(exclude, list):
-            exc = (path for dir in exclude for path in subpaths(dir))
+            exc = {entry.path for dir in exclude for entry in _subentries(dir)}
         else:
             raise NotImplementedError
-        for exc_path in exc:  # Remove all the excluded paths.
-            try:
-                paths.remove(exc_path)
-            except ValueError:
-                continue
+        # Walk roots are resolved, so the same file found via either search has the same path.
+        entries = [entry for entry in entries if entry.path not in exc]
+
+    # Paths are handled as strings until they are returned, which are cheaper to build, hash and compare than Paths.
+    # Only files of equal size, then with equal first and last blocks, can be duplicates. Blocks are grouped by a CRC32
+    # fingerprint rather than their bytes, a collision only lets a file through to be hashed.
+    duplicates = {}  # Maps digests to the paths of the files with that content.
+    candidates = []
+    for size, size_group in _duplicate_groups((entry.path, entry.stat().st_size) for entry in entries).items():
+        if size <= COMPARE_BLOCK_SIZE:  # The first block is the whole file, so its bytes decide the group alone.
+            for content, group in _duplicate_groups((path, read_block(path, 0)) for path in size_group).items():
+                hasher = new_hasher()
+                hasher.update(content)
+                duplicates[hasher.digest()] = group
+            continue
+        candidates.extend(
+            _duplicate_groups((path, crc32(read_block(path, 0))) for path in size_group).values())
+    candidates = [group for head_group in candidates
+                  for group in _duplicate_groups((path, crc32(read_block(path, -1))) for path in head_group).values()]
+
+    # Hash every remaining candidate at once so they can be spread across threads.
+    duplicates.update(_duplicate_groups(_digest_many(path for group in candidates for path in group)))
+    return {digest.hex(): [Path(path) for path in paths] for digest, paths in duplicates.items()}
 
-    hash_path_dict = {}  # A dictionary mapping file hash to the file path.
-    for path in paths:
-        hash = hash_from_path(path)
-        try:
-            hash_path_dict[hash].append(path)
-        except KeyError:
-            hash_path_dict[hash] = [path]
 
-    # Filter through to find the hashes with multiple paths mapped (these are dup files).
-    return dict(filter(lambda kvp: True if len(kvp[1]) > 1 else False, hash_path_dict.items()))
+def read_block(path: Path | str, index: int, size: int = COMPARE_BLOCK_SIZE) -> bytes:
+    """
+    Reads a block of bytes from a file, used to cheaply tell apart files before hashing them.
+    :param path: The path of the file to read from.
+    :param index: The index of the block to read, negative indices count back from the end of the file.
+    :param size: The size of the block in bytes.
+    :return: The bytes of the block, shorter than size if the file ends first.
+    """
+    with open(path, 'rb') as f:
+        if index < 0:
+            f.seek(max(f.seek(0, SEEK_END) + index * size, 0))
+        else:
+            f.seek(index * size)
+        return f.read(size)
+
+
+def _default_workers() -> int:
+    """
+    The number of threads used by the pools in this module when no number is given, four per CPU (at most 32).
+    """
+    return min(32, (cpu_count() or 1) * 4)
+
+
+def _duplicate_groups(pairs: Iterable[tuple[str, object]]) -> dict[object, list[str]]:
+    """
+    Groups paths by a key, keeping only the groups that contain more than one path.
+    :param pairs: An iterable of (path, key) pairs.
+    :return: A dictionary mapping each shared key to the paths that have it.
+    """
+    groups = defaultdict(list)
+    for path, key in pairs:
+        groups[key].append(path)
+    return {key: group for key, group in groups.items() if len(group) > 1}
 
 
 def remove(paths: Path | list[Path]) -> list[Path]:
@@ -140,13 +449,150 @@ def remove(paths: Path | list[Path]) -> list[Path]:
     return failed
 
 
-def remove_duplicates(directory: Path):
+def remove_duplicates(directory: Path | str) -> list[Path]:
     """
-    Removes duplicate files from the given directory based on content.
+    Removes duplicate files from the given directory based on content, keeping one copy of each. The copy kept for
+    each content is recorded in the hash cache, so later runs on the same directory only hash new or changed files
+    and remove any whose recorded copy still exists. Only files sharing their size with another file, or with a
+    recorded copy, are hashed.
     :param directory: The directory to check for duplicates.
     :return: A list of duplicates that failed to be removed.
     """
-    return remove(get_duplicates(directory))
+    root = str(path_handler(directory).resolve())
+    canonical = _load_canonical(root)  # Maps each digest to the (path, size) of the copy that is kept.
+    checked = set()  # Canonical paths confirmed to still hold their content this run.
+    changed = {}  # Canonical paths recorded this run, to be saved.
+    failed = []  # Duplicates that failed to be removed.
+    # Symlinks are skipped, so neither a removed file nor a kept copy can be a link to the other.
+    sizes = [(entry.path, entry.stat(follow_symlinks=False).st_size)
+             for entry in _subentries(root, follow_symlinks=False)]
+    shared = set(_duplicate_groups(sizes)) | {size for _, size in canonical.values()}
+    candidates = {path: size for path, size in sizes if size in shared}
+    pending = list(candidates)
+    for _ in range(2):  # A second pass re-examines files whose cached digest turned out to be stale.
+        duplicates = []  # (path, kept copy) pairs.
+        for path, digest in _digest_many(pending):
+            kept = canonical[digest][0] if digest in canonical else None
+            if kept == path:
+                checked.add(path)
+            elif kept is not None and (kept in checked or _holds_digest(kept, digest)):
+                checked.add(kept)
+                if not _same_file(path, kept):  # Hard links share their content, removing one frees nothing.
+                    duplicates.append((path, kept))
+            else:  # First copy seen, or the recorded copy has since been removed or changed.
+                canonical[digest] = changed[digest] = (path, candidates.get(path) or stat(path).st_size)
+                checked.add(path)
+        if not duplicates:
+            break
+        with ThreadPoolExecutor(max_workers=_default_workers()) as executor:
+            results = list(executor.map(lambda pair: _remove_copy(*pair), duplicates))
+        failed.extend(path for (path, _), removed in zip(duplicates, results) if removed is False)
+        stale = [pair for pair, removed in zip(duplicates, results) if removed is None]
+        # The digest of one of each stale pair is wrong, so both are forgotten and hashed again.
+        pending = list(dict.fromkeys(path for pair in stale for path in pair))
+        for path in pending:
+            _forget_digest(path)
+            checked.discard(path)
+        forgotten = set(pending)
+        for digest, (path, _) in list(canonical.items()):
+            if path in forgotten:  # The kept copy may be recorded under its stale digest.
+                del canonical[digest]
+                changed.pop(digest, None)
+        if not pending:
+            break
+    _save_canonical(root, changed)
+    return [Path(p) for p in failed]
+
+
+def _remove_copy(path: str, kept: str) -> bool | None:
+    """
+    Removes a file found to be a duplicate of a kept copy, after comparing their bytes. Cached digests can be stale
+    when a file is rewritten with its size and modification time preserved, so they are not trusted for removal.
+    :param path: The path of the duplicate to remove.
+    :param kept: The path of the kept copy.
+    :return: True if the file was removed, False if removing it failed, None if its contents differ from the copy.
+    """
+    try:
+        if not _contents_equal(path, kept):
+            return None
+        osrmv(path)
+    except OSError:  # Any failure is reported rather than stopping the other removals.
+        return False
+    return True
+
+
+def _contents_equal(file1: str, file2: str) -> bool:
+    """
+    Compares the bytes of two files, reading them a chunk at a time.
+    :param file1: The path of one of the files.
+    :param file2: The path of the other file.
+    :return: boolean True if both files have the same contents.
+    """
+    with open(file1, 'rb') as f1, open(file2, 'rb') as f2:
+        while True:
+            chunk1, chunk2 = f1.read(HASH_CHUNK_SIZE), f2.read(HASH_CHUNK_SIZE)
+            if chunk1 != chunk2:
+                return False
+            if not chunk1:
+                return True
+
+
+def _holds_digest(path: str, digest: bytes) -> bool:
+    """
+    Checks a file recorded as the kept copy of some content still exists with that content, using the hash cache.
+    :param path: The path of the kept copy.
+    :param digest: The digest the file is expected to have.
+    :return: boolean True if the file exists, is not a symlink and has the given digest.
+    """
+    try:
+        return not ospath.islink(path) and _digest(path) == digest
+    except OSError:
+        return False
+
+
+def _same_file(file1: str, file2: str) -> bool:
+    """
+    Checks whether two paths are the same file on disk, as files_equal does.
+    :param file1: The path of one of the files.
+    :param file2: The path of the other file.
+    :return: boolean True if both paths have the same device and inode.
+    """
+    try:
+        st1, st2 = stat(file1), stat(file2)
+    except OSError:
+        return False
+    return bool(st1.st_ino) and (st1.st_dev, st1.st_ino) == (st2.st_dev, st2.st_ino)
+
+
+def _load_canonical(root: str) -> dict[bytes, tuple[str, int]]:
+    """
+    Loads the kept copy of each content recorded by earlier runs of remove_duplicates on a directory.
+    :param root: The resolved path of the directory.
+    :return: A dictionary mapping digests to the (path, size) of the kept copy, empty if the hash cache is disabled.
+    """
+    with _hash_db_lock:
+        db = _hash_cache()
+        if db is None:
+            return {}
+        try:
+            return {digest: (path, size) for digest, path, size in db.execute(
+                'SELECT digest, path, size FROM kept_copies WHERE root = ? AND backend = ?', (root, HASH_BACKEND))}
+        except SQLiteError:  # Without the recorded copies, the first copy found this run is kept.
+            return {}
+
+
+def _save_canonical(root: str, canonical: dict[bytes, tuple[str, int]]):
+    """
+    Records the kept copy of each content found by remove_duplicates in a single transaction, replacing any recorded
+    before.
+    :param root: The resolved path of the directory.
+    :param canonical: A dictionary mapping digests to the (path, size) of the kept copy.
+    """
+    with _hash_db_lock:
+        db = _hash_cache()
+        if db is not None and canonical:
+            _write_cache(db, 'INSERT OR REPLACE INTO kept_copies VALUES (?, ?, ?, ?, ?)',
+                         ((root, HASH_BACKEND, digest, path, size) for digest, (path, size) in canonical.items()))
 
 
 def create_test_directory(depth, location=syspath[0], duplicate_percentage=25, max_directs=5, max_files=100):
@@ -159,7 +605,7 @@ def create_test_directory(depth, location=syspath[0], duplicate_percentage=25, m
     :param max_files: The maximum number of files that can be created on each level of the tree.
     :return:
     """
-    location = path_handler(location).resolve()
+    location = ospath.abspath(path_handler(location))
     if depth == 0:
         return
     chdir(location)
@@ -171,17 +617,13 @@ def create_test_directory(depth, location=syspath[0], duplicate_percentage=25, m
     num_files = randint(1, max_files)
     dup_files = int(num_files * (duplicate_percentage / 100))
     unique_files = num_files - dup_files
-    # Create the dup files
-    for i in range(dup_files):
-        file_name = "file_" + str(i) + ".txt"
-        with open(file_name, 'w') as f:
-            f.write("This is a randomly generated duplicate file.")
-    # Create the unique files
-    for i in range(dup_files, unique_files + dup_files):
-        file_name = "file_" + str(i) + ".txt"
-        with open(file_name, 'w') as f:
-            f.write(
-                f'This is a randomly generated unique file. Path hash: {hash(str(location) + file_name)}')
+    for file_name, content in _test_payloads(location, dup_files, unique_files):
+        # Written straight to the file descriptor, skipping the buffered file object for these tiny files.
+        fd = osopen(file_name, O_WRONLY | O_CREAT | O_TRUNC, 0o644)
+        try:
+            oswrite(fd, content)
+        finally:
+            osclose(fd)
     # Do the same again for some of the directories we just created.
     for i in range(num_direc):
         # 50% of the subdirectories will have subdirectories.
@@ -190,12 +632,32 @@ def create_test_directory(depth, location=syspath[0], duplicate_percentage=25, m
                 depth - 1, location = ospath.join(location, f'dir_{i}'))
 
 
+def _test_payloads(location: str, dup_files: int, unique_files: int) -> Generator[tuple[str, bytes]]:
+    """
+    Generates the names and contents of the text files that create_test_directory writes into one folder.
+    :param location: The folder the files will be written to, used to make the unique contents unique.
+    :param dup_files: The number of files that share the same content.
+    :param unique_files: The number of files with content of their own.
+    :return: An iterable of (file name, content) pairs, duplicates first.
+    """
+    for i in range(dup_files):
+        yield f'file_{i}.txt', _DUP_TEST_CONTENT
+    for i in range(dup_files, unique_files + dup_files):
+        file_name = f'file_{i}.txt'
+        yield file_name, b'This is a randomly generated unique file. Path hash: %d' % hash(location + file_name)
+
+
 def path_handler(path: str | Path) -> Path:
     """
     Takes an input string or path and returns a path object allowing other functions to handle both strings and paths with only one line.
     :param path: The string or Path object.
     :return: A path object.
     """
+    path_type = type(path)
+    if path_type is _PATH_TYPE:  # Exact type checks come first as they are cheaper than isinstance.
+        return path
+    if path_type is str:
+        return _PATH_TYPE(path)
     if isinstance(path, Path):
         return path
     if isinstance(path, str):
@@ -0,0 +1,108 @@
+"""
+Tests for the functions in fsf that remove files.
+"""
+import os
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+import fsf
+
+
+class RemoveDuplicatesTest(unittest.TestCase):
+    """
+    Checks remove_duplicates only ever removes a file when another real copy of its content is kept.
+    """
+
+    def setUp(self):
+        self._tmp = TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+        self.root = Path(self._tmp.name).resolve() / 'tree'
+        self.root.mkdir()
+        # Keep the hash cache for each test to itself.
+        cache_patch = mock.patch.object(fsf, 'HASH_CACHE_PATH', Path(self._tmp.name) / 'cache' / 'hashes.sqlite')
+        cache_patch.start()
+        self.addCleanup(cache_patch.stop)
+        fsf._hash_memo.clear()
+        self.addCleanup(fsf._hash_memo.clear)
+
+    def write(self, name: str, content: str) -> Path:
+        path = self.root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+        return path
+
+    def remaining(self) -> dict[str, str]:
+        """
+        Maps the path of every regular file left in the tree, relative to its root, to its content.
+        """
+        return {str(p.relative_to(self.root)): p.read_text() for p in self.root.rglob('*')
+                if p.is_file() and not p.is_symlink()}
+
+    def test_removes_copies(self):
+        self.write('a.txt', 'same')
+        self.write('sub/b.txt', 'same')
+        self.write('c.txt', 'other')
+        self.assertEqual(fsf.remove_duplicates(self.root), [])
+        self.assertEqual(sorted(self.remaining().values()), ['other', 'same'])
+
+    def test_symlinked_folder_keeps_target(self):
+        self.write('data/x.txt', 'only copy')
+        (self.root / 'alias').symlink_to('data', target_is_directory=True)
+        self.assertEqual(fsf.remove_duplicates(self.root), [])
+        self.assertEqual(self.remaining(), {'data/x.txt': 'only copy'})
+        self.assertTrue((self.root / 'alias' / 'x.txt').exists())
+
+    def test_symlinked_file_keeps_target(self):
+        # Named to be listed before its target.
+        (self.root / 'a_link.txt').symlink_to('z_target.txt')
+        self.write('z_target.txt', 'only copy')
+        self.assertEqual(fsf.remove_duplicates(self.root), [])
+        self.assertEqual(self.remaining(), {'z_target.txt': 'only copy'})
+        self.assertTrue((self.root / 'a_link.txt').exists())
+
+    def test_hard_link_to_kept_copy_is_kept(self):
+        target = self.write('x.txt', 'linked')
+        os.link(target, self.root / 'y.txt')
+        self.assertEqual(fsf.remove_duplicates(self.root), [])
+        self.assertEqual(self.remaining(), {'x.txt': 'linked', 'y.txt': 'linked'})
+
+    def test_stale_cached_digest_does_not_remove(self):
+        self.write('a.txt', 'same')
+        b = self.write('b.txt', 'same')
+        fsf.hash_from_path(b)  # Cache the digest of the original content.
+        st = b.stat()
+        b.write_text('diff')  # Rewrite keeping the size and modification time, as cp -p or rsync -t can.
+        os.utime(b, ns=(st.st_atime_ns, st.st_mtime_ns))
+        fsf.remove_duplicates(self.root)
+        self.assertEqual(self.remaining(), {'a.txt': 'same', 'b.txt': 'diff'})
+
+    def test_stale_cached_digest_is_rehashed(self):
+        self.write('a.txt', 'same')
+        b = self.write('b.txt', 'same')
+        self.write('c.txt', 'diff')
+        fsf.hash_from_path(b)
+        st = b.stat()
+        b.write_text('diff')
+        os.utime(b, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual(fsf.remove_duplicates(self.root), [])
+        # b is hashed again and found to be a copy of c.
+        self.assertEqual(sorted(self.remaining().values()), ['diff', 'same'])
+        with mock.patch.object(fsf, '_remove_copy', wraps=fsf._remove_copy) as remove_copy:
+            fsf.remove_duplicates(self.root)
+        remove_copy.assert_not_called()
+
+    def test_failed_removal_is_reported(self):
+        self.write('a.txt', 'same')
+        self.write('b.txt', 'same')
+        self.write('c.txt', 'same')
+        with mock.patch.object(fsf, 'osrmv', side_effect=PermissionError):
+            failed = fsf.remove_duplicates(self.root)
+        self.assertEqual(len(failed), 2)
+        self.assertTrue(all(isinstance(p, Path) for p in failed))
+        self.assertEqual(len(self.remaining()), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()